@@ -0,0 +1,80 @@
+from collections import Counter, OrderedDict, deque
+import threading
+import time
+
+
+class ActionPipeline:
+    """Run actions on users' questions in the background.
+
+    Actions of a user run one at a time in submission order,
+    while actions of different users run concurrently on `executor`.
+    An action on a question that is queued or was recently done is dropped.
+    Actions signal failure by raising, failed questions can be submitted again.
+    """
+
+    def __init__(self, executor, logger, *, recent_size=1000):
+        self.executor = executor
+        self.logger = logger
+        self.recent_size = recent_size
+        self.lock = threading.Lock()
+        self.queues = {}  # uname -> deque of (qid, func, submitted_at)
+        self.pending = {}  # uname -> qids in the queue
+        self.recent = {}  # uname -> OrderedDict of done qids
+        self.stats = Counter()
+        self.max_latency = 0
+
+    def submit(self, uname, qid, func):
+        """Queue `func()` acting on the question `qid`, return whether it was queued."""
+        with self.lock:
+            pending = self.pending.setdefault(uname, set())
+            if qid in pending or qid in self.recent.get(uname, ()):
+                self.stats["dropped"] += 1
+                return False
+            pending.add(qid)
+            start_drain = uname not in self.queues
+            queue = self.queues.setdefault(uname, deque())
+            queue.append((qid, func, time.monotonic()))
+            self.stats["submitted"] += 1
+        if start_drain:
+            self.executor.submit(self.drain, uname)
+        return True
+
+    def drain(self, uname):
+        while True:
+            with self.lock:
+                queue = self.queues[uname]
+                if not queue:
+                    del self.queues[uname]
+                    return
+                qid, func, submitted_at = queue.popleft()
+            ok = False
+            try:
+                func()
+                ok = True
+            except Exception:  # the queue would get stuck otherwise
+                self.logger.exception(f"Action on {qid} for {uname}:")
+            with self.lock:
+                self.pending[uname].discard(qid)
+                if ok:
+                    recent = self.recent.setdefault(uname, OrderedDict())
+                    recent[qid] = None
+                    if len(recent) > self.recent_size:
+                        recent.popitem(last=False)
+                latency = time.monotonic() - submitted_at
+                self.stats["done" if ok else "failed"] += 1
+                self.stats["latency_sec"] += latency
+                self.max_latency = max(self.max_latency, latency)
+
+    def status(self):
+        with self.lock:
+            now = time.monotonic()
+            heads = [q[0][2] for q in self.queues.values() if q]
+            done = self.stats["done"] + self.stats["failed"]
+            return {
+                "depth": sum(len(q) for q in self.queues.values()),
+                "busy_users": len(self.queues),
+                "oldest_sec": now - min(heads) if heads else 0,
+                "avg_latency_sec": self.stats["latency_sec"] / done if done else 0,
+                "max_latency_sec": self.max_latency,
+                **self.stats,
+            }
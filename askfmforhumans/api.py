@@ -1,17 +1,48 @@
-from functools import cached_property
-from itertools import takewhile
-
-from askfm_api import AskfmApi, AskfmApiError, requests
-
-from askfmforhumans.app import AppModuleBase
-from askfmforhumans.util import LRUCache, MyDataclass
-
-CACHE_SIZE = 32
+from collections import Counter
+from dataclasses import field
+from itertools import count, islice, takewhile
+import json
+import random
+import tempfile
+import threading
+import time
+
+from askfm_api import DEFAULT_LIMIT, AskfmApi, AskfmApiError, requests
+from askfm_api.errors import OperationError, TryAgainError
+import requests as http
+from requests.adapters import HTTPAdapter
+
+from askfmforhumans.app import AppModuleBase, IntervalJob
+from askfmforhumans.util import MyDataclass, TokenBucket
+
+NETWORK_ERRORS = (http.ConnectionError, http.Timeout)
+# Requests that are safe to repeat when we don't know if the previous attempt succeeded.
+# An `OperationError` on a repeated attempt means that the previous one went through.
+REPEATABLE = {
+    "delete_question",
+    "report_question",
+    "post_answer",
+    "delete_answer",
+    "mark_notifs_as_read",
+}
+# Enough to get past the daily question, which may come first.
+PROBE_LIMIT = 2
+# Fields of question objects used by `models.Question`.
+QUESTION_KEYS = ("qid", "type", "author", "body", "createdAt", "updatedAt")
 
 
 class ApiManagerConfig(MyDataclass):
     signing_key: str
     dry_mode: bool = False
+    rate_per_sec: float = 0  # no limit
+    burst: int = 20
+    account_rate_per_sec: float = 0
+    account_burst: int = 10
+    account_limits: dict = field(default_factory=dict)
+    max_retries: int = 3
+    retry_base_sec: float = 1
+    stats_interval_sec: int = 600
+    pool_maxsize: int = 16
 
 
 class ApiManager(AppModuleBase):
@@ -19,64 +50,173 @@ class ApiManager(AppModuleBase):
         super().__init__(info, config_factory=ApiManagerConfig.from_dict)
         if dry_mode := self.config.dry_mode:
             self.logger.warning(f"{dry_mode=}")
-
-    def create_api(self, **kwargs):
-        return ExtendedApi(
-            self.logger,
-            self.config.signing_key,
-            dry_mode=self.config.dry_mode,
-            **kwargs,
+        cfg = self.config
+        self.limiter = TokenBucket(cfg.rate_per_sec, cfg.burst)
+        # Shared by all clients, so they reuse keep-alive connections to the API host.
+        # Blocks when all connections are busy instead of opening extra ones.
+        self.adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=cfg.pool_maxsize, pool_block=True
+        )
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+        self._anon = threading.local()
+        self.add_job(
+            IntervalJob(
+                "stats",
+                self.log_stats,
+                cfg.stats_interval_sec,
+                priority=1,
+                sheddable=True,
+            )
         )
 
-    @cached_property
+    def create_api(self, *, account=None, **kwargs):
+        """Create an API client limited both globally and per `account`."""
+        cfg = self.config
+        limits = {
+            "rate_per_sec": cfg.account_rate_per_sec,
+            "burst": cfg.account_burst,
+            **cfg.account_limits.get(account, {}),
+        }
+        limiters = [self.limiter]
+        if account is not None:
+            limiters.append(TokenBucket(limits["rate_per_sec"], limits["burst"]))
+        return ExtendedApi(self, cfg.signing_key, limiters=limiters, **kwargs)
+
+    def count(self, key, value=1):
+        with self._stats_lock:
+            self.stats[key] += value
+
+    def log_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        self.logger.info(f"API stats: {stats}")
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            # Each request either reuses an idle connection or opens a new one.
+            self.logger.info(
+                f"API pool {key.key_host}: requests={pool.num_requests}"
+                f" opened={pool.num_connections} idle={pool.pool.qsize()}"
+                f" maxsize={self.config.pool_maxsize}"
+            )
+
+    @property
     def anon_api(self):
-        return self.create_api()
+        """A client not logged in, one per thread as clients send requests one by one."""
+        if (api := getattr(self._anon, "api", None)) is None:
+            api = self._anon.api = self.create_api()
+        return api
 
 
 class ExtendedApi(AskfmApi):
-    def __init__(self, logger, *args, dry_mode=False, **kwargs):
+    def __init__(self, mgr, *args, limiters=(), **kwargs):
         # super().__init__() calls request(), so this should come before.
-        self.logger = logger
-        self.dry_mode = dry_mode
+        self.mgr = mgr
+        self.logger = mgr.logger
+        self.dry_mode = mgr.config.dry_mode
+        self.limiters = limiters
+        # Requests are chained through `rt` (see `AskfmApi.request_raw`),
+        # so a client must not send them concurrently, e.g. from actions and jobs.
+        self.lock = threading.Lock()
         super().__init__(*args, **kwargs)
+        # Auth headers stay in our own session, only the transport is shared.
+        self.sess.mount("https://", mgr.adapter)
 
-        self._new_qs = 0
-        self.cache = LRUCache(CACHE_SIZE)
+        self.questions_cursor = None
+        self.shoutouts_cursor = None  # see `UserWorker.shoutout_job`
 
     def request(self, req, **kwargs):
         if not self.dry_mode or req.method == "GET" or req.name == "log_in":
-            return super().request(req, **kwargs)
+            return self.request_with_retries(req, **kwargs)
         self.logger.info(f"Dry mode: ignoring {req.method=} {req.path=} {req.params=}")
         return {}
 
-    def fetch_new_questions(self):
-        """Return an iterator to all questions up to the first that was already seen.
-
-        It counts as seen only questions retrieved in previous invocations of this method.
+    def request_with_retries(self, req, **kwargs):
+        cfg = self.mgr.config
+        maybe_done = False
+        for attempt in count():
+            try:
+                return super().request(req, **kwargs)
+            except (TryAgainError, *NETWORK_ERRORS) as e:
+                # The server doesn't perform a request it asks to retry.
+                safe = isinstance(e, TryAgainError)
+                safe = safe or req.method == "GET" or req.name in REPEATABLE
+                if attempt >= cfg.max_retries or not safe:
+                    raise
+                maybe_done = maybe_done or not isinstance(e, TryAgainError)
+                delay = cfg.retry_base_sec * 2**attempt * random.uniform(0.5, 1.5)
+                self.logger.info(f"Retrying {req.name} in {delay:.1f}s: {e!r}")
+                self.mgr.count("retries")
+                self.mgr.count("retry_sec", delay)
+                time.sleep(delay)
+            except OperationError:
+                if maybe_done and req.name in REPEATABLE:
+                    self.logger.info(f"Assuming {req.name} succeeded before")
+                    return {}
+                raise
+
+    def request_raw(self, *args, **kwargs):
+        for limiter in self.limiters:
+            if waited := limiter.acquire():
+                self.mgr.count("throttled_sec", waited)
+        self.mgr.count("requests")
+        with self.lock:
+            return super().request_raw(*args, **kwargs)
+
+    def fetch_new_questions(self, *, cursor_attr="questions_cursor"):
+        """Return an iterator to all questions newer than the cursor in `cursor_attr`.
+
+        The cursor is the greatest `(updatedAt, qid)` of questions returned before.
+        The list is sorted by `updatedAt`, so iteration stops at the first question
+        not above the cursor, no matter how many questions were deleted since.
+        The cursor is advanced once the iterator is exhausted.
         The daily question is always included (if it exists).
-        The cache is bounded, thus it may not function properly
-        when a lot of questions have been deleted.
         """
+        cursor = getattr(self, cursor_attr)
+        new_cursor = cursor
         new_qs = 0
         for q in self.request_iter(requests.fetch_questions()):
             if q["type"] != "daily":
-                is_new = True
-            elif new_qs >= CACHE_SIZE:
-                # The cache is already filled with new questions
-                # so there's no use to look at it.
-                is_new = True
-            else:
-                # We need to consider `updatedAt` because when it changes
-                # the question changes its position in the list.
-                q_info = (q["qid"], q["updatedAt"])
-                # Returns True if q is already in the cache.
-                is_new = not self.cache.check_and_store(q_info)
-
-            if is_new:
+                key = (q["updatedAt"], q["qid"])
+                if cursor is not None and key <= cursor:
+                    break
+                if new_cursor is None or key > new_cursor:
+                    new_cursor = key
                 new_qs += 1
-                yield q
-            else:
-                break
+            yield q
+
+        setattr(self, cursor_attr, new_cursor)
+        self.logger.debug(
+            f"fetch_new_questions(): {cursor_attr=} {new_qs=} {new_cursor=}"
+        )
+
+    def newest_question_key(self):
+        """Return `(updatedAt, qid)` of the newest non-daily question, or None.
 
-        hits, misses, *_ = self.cache.cache_info()
-        self.logger.debug(f"fetch_new_questions(): {new_qs=}, {hits=}, {misses=}")
+        Only the head of the first page is fetched, so it's a single tiny request.
+        """
+        for q in self.request(requests.fetch_questions(), limit=PROBE_LIMIT):
+            if q["type"] != "daily":
+                return (q["updatedAt"], q["qid"])
+        return None
+
+    def fetch_questions_oldest_first(self):
+        """Return an iterator to all questions from the oldest to the newest.
+
+        Questions are spilled to a temporary file page by page, keeping only
+        `QUESTION_KEYS`, so memory use doesn't grow with the inbox size.
+        """
+        with tempfile.TemporaryFile() as f:
+            offsets = []
+            qs = self.request_iter(requests.fetch_questions())
+            while page := list(islice(qs, DEFAULT_LIMIT)):
+                offsets.append(f.tell())
+                page = [[q[k] for k in QUESTION_KEYS] for q in page]
+                f.write(json.dumps(page).encode() + b"\n")
+
+            self.logger.debug(f"fetch_questions_oldest_first(): {f.tell()=}")
+            for offset in reversed(offsets):
+                f.seek(offset)
+                for values in reversed(json.loads(f.readline())):
+                    yield dict(zip(QUESTION_KEYS, values))
@@ -1,7 +1,12 @@
 from __future__ import annotations
 
+import asyncio
+from collections import Counter
 from dataclasses import field
 import datetime
+import heapq
+import inspect
+import itertools
 import logging
 import sched
 import time
@@ -21,6 +26,9 @@ class AppModuleBase:
         job.name = f"{self.mod_info.name}.{job.name}"
         self.mod_info.app.add_job(job)
 
+    def remove_job(self, job):
+        self.mod_info.app.remove_job(job.name)
+
 
 class AppModuleInfo:
     name: str
@@ -45,10 +53,19 @@ class AppModuleInfo:
 
 
 class AppJob:
-    def __init__(self, name, func, *, priority=0):
+    def __init__(self, name, func, *, priority=0, sheddable=False, executor=None):
         self.name = name
         self.func = func
         self.priority = priority
+        # Sheddable jobs are skipped when they start too late (see `App.run_job`).
+        self.sheddable = sheddable
+        # Where `run_async` runs a plain function (None is the loop's default one).
+        self.executor = executor
+        self.due_at = 0  # when the job is (or was last) scheduled to run
+        self.stats = Counter()
+        self.last_lag = 0
+        self.last_duration = 0
+        self.max_duration = 0
 
     def first_time(self):
         raise NotImplementedError
@@ -66,7 +83,52 @@ class IntervalJob(AppJob):
         return 0  # meaning "run ASAP"
 
     def next_time(self):
-        return time.time() + self.interval_sec
+        """Return the next tick, coalescing any ticks missed by overrunning."""
+        now = time.time()
+        if not self.due_at:
+            return now + self.interval_sec
+        nt = self.due_at + self.interval_sec
+        if nt <= now:
+            missed = int((now - nt) // self.interval_sec) + 1
+            self.stats["overruns"] += 1
+            self.stats["coalesced"] += missed
+            nt += missed * self.interval_sec
+        return nt
+
+
+class SliceJob(IntervalJob):
+    """Interval job that does its work in time-bounded slices.
+
+    `func` returns an iterator doing a bit of work on every step.
+    Each run advances it for up to `budget_sec`, and while it's unfinished
+    the job is rescheduled immediately, i.e. after other jobs that are already due.
+    """
+
+    def __init__(self, name, func, interval_sec, budget_sec, **kwargs):
+        super().__init__(name, self.run_slice, interval_sec, **kwargs)
+        self.make_task = func
+        self.budget_sec = budget_sec
+        self.task = None
+
+    def run_slice(self):
+        if self.task is None:
+            self.task = iter(self.make_task())
+            self.round_due = self.due_at
+        deadline = time.monotonic() + self.budget_sec
+        try:
+            for _ in self.task:
+                if time.monotonic() >= deadline:
+                    return
+        except BaseException:
+            self.task = None
+            raise
+        self.task = None
+
+    def next_time(self):
+        if self.task is not None:
+            return time.time()
+        self.due_at = self.round_due
+        return super().next_time()
 
 
 class DailyJob(AppJob):
@@ -99,6 +161,9 @@ class App:
         self.modules = {}
         self.jobs = {}
         self.scheduler = sched.scheduler(timefunc=time.time)
+        self._async_queue = None
+        self.created_at = time.monotonic()
+        self.first_job_at = None
 
     def use_module(self, module):
         if module.name in self.modules:
@@ -142,21 +207,161 @@ class App:
         self.jobs[job.name] = job
         self.schedule_job(job, first_time=True)
 
+    def remove_job(self, name):
+        # Its queue entry is skipped when it comes up.
+        del self.jobs[name]
+
+    def status(self):
+        """Return scheduling stats of all jobs."""
+        now = time.time()
+        jobs = {
+            name: {
+                # Jobs due ASAP that haven't run yet have no time.
+                "due_in_sec": job.due_at - now if job.due_at else None,
+                "last_lag_sec": job.last_lag,
+                "last_duration_sec": job.last_duration,
+                "max_duration_sec": job.max_duration,
+                **job.stats,
+            }
+            for name, job in self.jobs.items()
+        }
+        due_in = [j["due_in_sec"] for j in jobs.values()]
+        overdue = [-d for d in due_in if d is not None and d < 0]
+        return {
+            "asyncio": self._async_queue is not None,
+            "overdue_sec": max(overdue, default=0),
+            "jobs": jobs,
+        }
+
     def schedule_job(self, job, *, first_time):
         time = job.first_time() if first_time else job.next_time()
-        self.scheduler.enterabs(time, job.priority, self.run_job, (job,))
+        job.due_at = time
+        if self._async_queue is not None:
+            self._async_enter(time, job)
+        else:
+            self.scheduler.enterabs(time, job.priority, self.run_job, (job,))
 
     def run_job(self, job):
-        self.logger.debug(f"starting job {job.name!r}")
+        if self.jobs.get(job.name) is not job:
+            return  # removed
         start = time.monotonic()
+        ran = True
         try:
-            job.func()
+            ran = self.call_job(job)
         except (AppError, AskfmApiError):
             self.logger.exception("run_job:")
-        delta = time.monotonic() - start
-        self.logger.debug(f"finished job in {delta:.2f}s")
+        self.finish_job(job, time.monotonic() - start, ran=ran)
+
+    def call_job(self, job):
+        """Call a sync job, unless it's sheddable and the app is falling behind.
+
+        Return whether it was called.
+        """
+        job.last_lag = time.time() - job.due_at if job.due_at else 0
+        if job.sheddable and job.last_lag > self.config.get("shed_lag_sec", 60):
+            self.logger.info(f"shedding job {job.name!r}: {job.last_lag=:.1f}s")
+            job.stats["shed"] += 1
+            return False
+        self.job_started(job)
+        job.func()
+        return True
+
+    def job_started(self, job):
+        if self.first_job_at is None:
+            self.first_job_at = time.monotonic()
+            delta = self.first_job_at - self.created_at
+            self.logger.info(f"time to first job: {delta:.2f}s ({job.name!r})")
+        self.logger.debug(f"starting job {job.name!r}")
+
+    def finish_job(self, job, delta, *, ran=True):
+        if ran:  # shed runs are only counted as such
+            job.stats["runs"] += 1
+            job.last_duration = delta
+            job.max_duration = max(job.max_duration, delta)
+            self.logger.debug(f"finished job {job.name!r} in {delta:.2f}s")
+        if self.jobs.get(job.name) is not job:
+            return  # removed while running
+        coalesced = job.stats["coalesced"]
         self.schedule_job(job, first_time=False)
+        if missed := job.stats["coalesced"] - coalesced:
+            self.logger.warning(f"job {job.name!r} overran, skipping {missed} run(s)")
 
     def run(self):
-        self.scheduler.run()
+        if self.config.get("asyncio"):
+            asyncio.run(self.run_async())
+        else:
+            self.scheduler.run()
         self.logger.warning("No more jobs to run. Stopping the app.")
+
+    async def run_async(self):
+        """Run jobs on an event loop, letting them overlap.
+
+        Jobs that are due at the same time are started in priority order, as with `run`.
+        Coroutine functions are awaited, plain functions are run on the job's executor.
+        A job is never run concurrently with itself.
+        Unexpected errors stop the loop and are raised, as with `run`.
+        """
+        self._async_queue = []
+        self._async_seq = itertools.count()
+        self._async_loop = asyncio.get_running_loop()
+        self._async_wakeup = asyncio.Event()
+        for event in self.scheduler.queue:
+            self.scheduler.cancel(event)
+            self._async_enter(event.time, *event.argument)
+
+        tasks, failed = set(), []
+
+        def on_done(task):
+            tasks.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                failed.append(task)
+            # Wake up even if nothing was queued, e.g. the last job was removed.
+            self._async_wakeup.set()
+
+        while (self._async_queue or tasks) and not failed:
+            now = time.time()
+            while self._async_queue and self._async_queue[0][0] <= now:
+                *_, job = heapq.heappop(self._async_queue)
+                task = asyncio.create_task(self.run_job_async(job))
+                tasks.add(task)
+                task.add_done_callback(on_done)
+
+            timeout = self._async_queue[0][0] - now if self._async_queue else None
+            self._async_wakeup.clear()
+            try:
+                await asyncio.wait_for(self._async_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self._async_queue = None
+        if failed:
+            failed[0].result()
+
+    async def run_job_async(self, job):
+        if self.jobs.get(job.name) is not job:
+            return  # removed
+        start = time.monotonic()
+        ran = True
+        try:
+            if inspect.iscoroutinefunction(job.func):
+                job.last_lag = time.time() - job.due_at if job.due_at else 0
+                self.job_started(job)
+                await job.func()
+            else:
+                # The lag is measured once the executor gets to the job.
+                loop = asyncio.get_running_loop()
+                ran = await loop.run_in_executor(job.executor, self.call_job, job)
+        except (AppError, AskfmApiError):
+            self.logger.exception("run_job_async:")
+        self.finish_job(job, time.monotonic() - start, ran=ran)
+
+    def _async_enter(self, time, job):
+        try:
+            in_loop = asyncio.get_running_loop() is self._async_loop
+        except RuntimeError:
+            in_loop = False
+        if not in_loop:  # e.g. a job added from a sync job on the executor
+            self._async_loop.call_soon_threadsafe(self._async_enter, time, job)
+            return
+        entry = (time, job.priority, next(self._async_seq), job)
+        heapq.heappush(self._async_queue, entry)
+        self._async_wakeup.set()
@@ -1,10 +1,18 @@
+from collections import deque
+import time
+
+from askfm_api import DEFAULT_LIMIT
+
 from askfmforhumans import ui_strings
+from askfmforhumans.api import AskfmApiError
 from askfmforhumans.api import requests as r
 from askfmforhumans.app import AppModuleBase, IntervalJob
 from askfmforhumans.errors import AppError
 from askfmforhumans.util import MyDataclass
 
 CREATED_BY = "discovery_hashtag"
+# Search results having these can be used as profiles (see `models.UserProfile`).
+PROFILE_KEYS = ("fullName", "bio", "hashtags")
 
 
 class BotConfig(MyDataclass):
@@ -12,13 +20,33 @@ class BotConfig(MyDataclass):
     search_by_hashtag: bool = True
     greet_users: bool = True
     tick_interval_sec: int = 30
+    full_discovery_interval_sec: int = 3600
+    onboard_interval_sec: int = 5
+    onboard_batch: int = 20
 
 
 class Bot(AppModuleBase):
     def __init__(self, info):
         super().__init__(info, config_factory=BotConfig.from_dict)
         self.umgr = info.app.require_module("user_mgr")
-        self.add_job(IntervalJob("tick", self.tick, self.config.tick_interval_sec))
+        self.add_job(
+            IntervalJob(
+                "tick",
+                self.tick,
+                self.config.tick_interval_sec,
+                priority=1,
+                sheddable=True,
+            )
+        )
+
+        # Most discovered users are set up by a separate job, not to hold up the search.
+        self.onboarding = deque()  # (uname, search result)
+        self.queued = set()
+        self.seen = set()  # onboarded or belonging to other instances
+        self.next_full_discovery = 0
+        self.add_job(
+            IntervalJob("onboard", self.onboard_users, self.config.onboard_interval_sec)
+        )
 
         self.user = self.umgr.get_or_create_user(self.config.username, {})
         self.api = self.user.api
@@ -30,14 +58,60 @@ class Bot(AppModuleBase):
             self.discover_users()
 
     def discover_users(self):
-        for user in self.api.request_iter(
+        """Queue new users having the hashtag and onboard the first `onboard_batch`.
+
+        The rest are left to the `onboard` job, so the search isn't held up for long.
+        Paging stops after a page worth of known users in a row,
+        and a full scan every `full_discovery_interval_sec` catches anyone missed.
+        """
+        now = time.monotonic()
+        full = now >= self.next_full_discovery
+        if full:
+            self.next_full_discovery = now + self.config.full_discovery_interval_sec
+        known_streak = 0
+        for found in self.api.request_iter(
             r.search_users_by_hashtag(self.umgr.config.hashtag)
         ):
-            uname = user["uid"]
-            if uname not in self.umgr.users:
-                user = self.umgr.get_or_create_user(uname, {"created_by": CREATED_BY})
-                if self.config.greet_users and user.allowed:
-                    self.greet_user(user)
+            uname = found["uid"]
+            if (
+                uname in self.umgr.users
+                or uname in self.queued
+                or (uname in self.seen and not full)
+            ):
+                known_streak += 1
+                if known_streak >= DEFAULT_LIMIT and not full:
+                    break
+                continue
+            known_streak = 0
+            self.queued.add(uname)
+            self.onboarding.append((uname, found))
+        if self.onboarding:
+            self.logger.debug(f"discover_users(): {full=} {len(self.onboarding)=}")
+            # Short-lived processes (see `deta/main.py`) may not get to the job.
+            self.onboard_users()
+
+    def onboard_users(self):
+        for _ in range(self.config.onboard_batch):
+            if not self.onboarding:
+                break
+            uname, found = self.onboarding.popleft()
+            try:
+                self.onboard_user(uname, found)
+            except (AppError, AskfmApiError):
+                self.logger.exception(f"Onboarding {uname}:")
+            finally:
+                self.queued.discard(uname)
+
+    def onboard_user(self, uname, found):
+        self.seen.add(uname)
+        if uname in self.umgr.users or not self.umgr.claim(uname):
+            return
+        profile = found if all(k in found for k in PROFILE_KEYS) else None
+        user = self.umgr.get_or_create_user(
+            uname, {"created_by": CREATED_BY}, profile=profile
+        )
+        if self.config.greet_users and user.allowed:
+            self.greet_user(user)
 
     def greet_user(self, user):
         uname = user.uname
@@ -1,15 +1,16 @@
-from pymongo import MongoClient
-import toml
-
-
 class DataManager:
     def __init__(self, *, config_file=None, db_url=None):
         if not config_file and not db_url:
             raise AssertionError("Data manager: no sources provided")
         self.config = self.db = None
+        # Imported only when needed, as they take a while to load.
         if config_file:
+            import toml
+
             self.config = toml.load(config_file)
         if db_url:
+            from pymongo import MongoClient
+
             self.db = MongoClient(db_url).get_default_database()
 
     def init_module(self, info):
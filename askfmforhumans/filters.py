@@ -0,0 +1,238 @@
+from collections import Counter, OrderedDict
+import hashlib
+import re
+import threading
+import time
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+MAX_REGEX_LEN = 200
+# Together these bound the time a regex takes on a text: even without nested
+# quantifiers, `(a|b)*(a|b)*(a|b)*c` backtracks polynomially (~17s on 300 chars).
+# With two quantifiers it's ~0.2s at worst, after which `regex_budget_ms` kicks in.
+MAX_REGEX_TEXT_LEN = 300
+MAX_REGEX_UNBOUNDED = 2
+_MISSING = object()
+_REPEATS = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+_GROUPREFS = (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS)
+
+
+def check_regex(pattern):
+    """Return why `pattern` can't be used as a filter, or None if it's fine.
+
+    Rejects patterns prone to catastrophic backtracking: backreferences
+    and unboundedly quantified groups that can match the same text in several ways,
+    i.e. containing other variable quantifiers like `(a+)+` or `(a|a?)+`
+    or alternatives not starting with distinct literals like `(a|aa)*`,
+    and patterns with more than `MAX_REGEX_UNBOUNDED` unbounded quantifiers.
+    """
+    if len(pattern) > MAX_REGEX_LEN:
+        return "too long"
+    try:
+        # Parsing alone misses some errors, e.g. variable-width look-behinds.
+        re.compile(pattern)
+        tree = sre_parse.parse(pattern)
+    except re.error as e:
+        return f"invalid: {e}"
+    unbounded = []
+    if r := _check_tree(tree, in_repeat=False, unbounded=unbounded):
+        return r
+    if len(unbounded) > MAX_REGEX_UNBOUNDED:
+        return "too many quantifiers"
+    return None
+
+
+def _check_tree(node, *, in_repeat, unbounded):
+    for op, av in node:
+        if op in _GROUPREFS:
+            return "backreference"
+        if op in _REPEATS:
+            min_, max_, item = av
+            if max_ == sre_parse.MAXREPEAT:
+                unbounded.append(item)
+            if in_repeat and min_ != max_:
+                return "nested quantifiers"
+            repeats = in_repeat or max_ > 1
+            if r := _check_tree(item, in_repeat=repeats, unbounded=unbounded):
+                return r
+            continue
+        if op == sre_parse.BRANCH and in_repeat:
+            firsts = [b[0] if len(b) else (None, None) for b in av[1]]
+            literals = {v for o, v in firsts if o == sre_parse.LITERAL}
+            if len(literals) < len(firsts):
+                return "ambiguous alternation in quantified group"
+        for item in av if isinstance(av, (tuple, list)) else (av,):
+            items = item if isinstance(item, list) else (item,)
+            for sub in items:
+                if isinstance(sub, sre_parse.SubPattern):
+                    if r := _check_tree(sub, in_repeat=in_repeat, unbounded=unbounded):
+                        return r
+    return None
+
+
+class AhoCorasick:
+    """Automaton finding which of the given words occur in a text in a single pass."""
+
+    def __init__(self, words):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [None]  # min index of a word that ends at this node
+        for i, word in enumerate(words):
+            node = 0
+            for ch in word:
+                if ch not in self.goto[node]:
+                    self.goto[node][ch] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(None)
+                node = self.goto[node][ch]
+            if self.out[node] is None:
+                self.out[node] = i
+
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[child] = self.goto[f].get(ch, 0)
+                self.out[child] = _min(self.out[child], self.out[self.fail[child]])
+
+    def search(self, text):
+        """Return the min index of a word found in `text`, or None."""
+        goto, fail, out = self.goto, self.fail, self.out
+        node = 0
+        found = None
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node] is not None:
+                found = _min(found, out[node])
+                if found == 0:
+                    break
+        return found
+
+
+def _min(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+class TextFilter:
+    """User's text filters compiled for matching many question bodies.
+
+    Substrings are matched case-insensitively by an Aho-Corasick automaton,
+    regexes are combined into a single alternation when possible.
+    Regexes are expected to be checked with `check_regex` beforehand.
+    """
+
+    def __init__(self, filters_str, filters_re):
+        self.filters_str = filters_str
+        self.automaton = AhoCorasick([s.lower() for s in filters_str])
+
+        self.patterns = [re.compile(p) for p in filters_re]
+
+        self.combined = None
+        # Wrapping in groups would break numbered backreferences, and on Python < 3.11
+        # inline global flags like `(?i)` would apply to all the alternatives.
+        if self.patterns and all(
+            p.groups == 0 and not p.flags & ~re.UNICODE for p in self.patterns
+        ):
+            alts = (f"(?P<f{i}>{p.pattern})" for i, p in enumerate(self.patterns))
+            try:
+                self.combined = re.compile("|".join(alts))
+            except re.error:  # fall back to matching one by one
+                pass
+
+    @property
+    def key(self):
+        """Identifies the filters, for `VerdictCache`."""
+        return (tuple(self.filters_str), tuple(p.pattern for p in self.patterns))
+
+    def disable_regexes(self):
+        self.patterns = []
+        self.combined = None
+
+    def __bool__(self):
+        return bool(self.filters_str or self.patterns)
+
+    def match(self, text):
+        """Return the filter matching `text`, or None."""
+        if (idx := self.automaton.search(text.lower())) is not None:
+            return self.filters_str[idx]
+        text = text[:MAX_REGEX_TEXT_LEN]
+        if self.combined is not None:
+            if m := self.combined.search(text):
+                return self.patterns[int(m.lastgroup[1:])].pattern
+        else:
+            for p in self.patterns:
+                if p.search(text):
+                    return p.pattern
+        return None
+
+
+class VerdictCache:
+    """Verdicts on question texts shared by all users, e.g. for broadcast shoutouts.
+
+    Keyed by a hash of the question's type, author and body, then by what was checked.
+    Entries expire after `ttl_sec`, and the least recently used ones
+    are evicted beyond `max_size`.
+    """
+
+    def __init__(self, max_size, ttl_sec):
+        self.max_size = max_size
+        self.ttl_sec = ttl_sec
+        self.entries = OrderedDict()  # key -> (expires_at, {check: verdict})
+        self.lock = threading.Lock()
+        self.stats = Counter()
+
+    def get(self, q, check, compute):
+        """Return the cached verdict of `check` on `q`, calling `compute()` on a miss.
+
+        Questions without a body (e.g. loaded from `QuestionIndex`) bypass the cache,
+        as they can't be told apart.
+        """
+        if not q.body:
+            self.stats["bypassed"] += 1
+            return compute()
+        text = f"{q.type}\0{q.author}\0{q.body}".encode()
+        key = hashlib.blake2b(text, digest_size=16).digest()
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                verdict = entry[1].get(check, _MISSING)
+                if verdict is not _MISSING:
+                    self.entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return verdict
+            self.stats["misses"] += 1
+
+        verdict = compute()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= now:
+                entry = self.entries[key] = (now + self.ttl_sec, {})
+            entry[1][check] = verdict
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+        return verdict
+
+    def status(self):
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                "size": len(self.entries),
+                "hit_rate": self.stats["hits"] / lookups if lookups else 0,
+                **self.stats,
+            }
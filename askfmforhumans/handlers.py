@@ -1,66 +1,119 @@
-import re
+from functools import partial
 import time
 
+from askfmforhumans.models import ANON_TYPES, REGULAR_TYPES, SHOUTOUT_TYPES
 from askfmforhumans.user import FilterSchedule
 
 SEC_IN_DAY = 60 * 60 * 24
 SEC_IN_YEAR = SEC_IN_DAY * 365
+JOBS = ("shoutouts", "short", "long")
+
+
+class HandlerPlan:
+    """Handlers applicable to each question type in each job, given user's settings.
+
+    Built once per settings change (see `UserWorker.plan_for`).
+    """
+
+    def __init__(self, handlers, user):
+        self.enabled = {}
+        self.table = {}
+        for job in JOBS:
+            enabled = tuple(h for h in handlers if h.enabled_for(user, job))
+            self.enabled[job] = enabled
+            for qtype in REGULAR_TYPES:
+                if job == "short" and ("shoutouts", qtype) in self.table:
+                    continue  # the shoutout lane takes these over
+                chain = tuple(h for h in enabled if qtype in h.question_types(user))
+                if chain:
+                    self.table[job, qtype] = chain
+
+    def dispatch(self, job, qtype):
+        return self.table.get((job, qtype), ())
+
+    def describe(self):
+        return {
+            f"{job}.{qtype}": [type(h).__name__ for h in chain]
+            for (job, qtype), chain in sorted(self.table.items())
+        }
 
 
 class Handler:
+    # Whether it only needs question fields stored in `QuestionIndex`
+    # (author and body are only logged) and only handles questions older than `min_age()`.
+    indexable = False
+
     def __init__(self, worker):
         self.worker = worker
 
-    def job_matches_schedule(self, user):
+    def job_matches_schedule(self, user, job):
         sch = user.settings.filter_schedule
-        job = self.worker.current_job
         return (sch, job) in (
             (FilterSchedule.CONTINUOUS, "short"),
             (FilterSchedule.DAILY, "long"),
         )
 
-    def enabled_for(self, user):
+    def enabled_for(self, user, job):
         raise NotImplementedError
 
+    def question_types(self, user):
+        """Return types of questions to pass to `handle_question`."""
+        if user.settings.filter_anon_only:
+            return REGULAR_TYPES & ANON_TYPES
+        return REGULAR_TYPES
+
     def handle_question(self, user, q):
         raise NotImplementedError
 
+    def min_age(self, user):
+        raise NotImplementedError
+
 
 class ShoutoutHandler(Handler):
-    def enabled_for(self, user):
-        return user.settings.filter_shoutouts and self.job_matches_schedule(user)
+    indexable = True
+
+    def min_age(self, user):
+        return 0
+
+    def enabled_for(self, user, job):
+        if self.worker.config.shoutout_interval_sec:
+            # New shoutouts are left to the shoutout lane, see `UserWorker.shoutout_job`.
+            job = {"short": None, "shoutouts": "short"}.get(job, job)
+        return user.settings.filter_shoutouts and self.job_matches_schedule(user, job)
+
+    def question_types(self, user):
+        return super().question_types(user) & SHOUTOUT_TYPES
 
     def handle_question(self, user, q):
-        if not q.is_shoutout or (not q.is_anon and user.settings.filter_anon_only):
-            return False
-        # Logging shoutout bodies is ok since they aren't private by definition
-        self.worker.logger.info(
-            f"Got {q.type}:{q.id} for {user.uname}: {q.author=} {q.body=}"
-        )
+        this = first_seen = f"{user.uname}:{q.id}"
+        if (verdicts := self.worker.verdicts) is not None:
+            # Log a shoutout wave in full only once.
+            first_seen = verdicts.get(q, "first_seen", lambda: this)
+        if first_seen == this:
+            # Logging shoutout bodies is ok since they aren't private by definition
+            self.worker.logger.info(
+                f"Got {q.type}:{q.id} for {user.uname}: {q.author=} {q.body=}"
+            )
+        else:
+            self.worker.logger.info(
+                f"Got {q.type}:{q.id} for {user.uname}: same as {first_seen}"
+            )
         self.worker.delete_question(user, q, block=user.settings.filter_block_authors)
         return True
 
 
 class TextFilterHandler(Handler):
-    def enabled_for(self, user):
-        return (
-            user.settings.filters_str or user.settings.filters_re
-        ) and self.job_matches_schedule(user)
+    def enabled_for(self, user, job):
+        return user.text_filter and self.job_matches_schedule(user, job)
 
     def handle_question(self, user, q):
-        if not q.is_regular or (not q.is_anon and user.settings.filter_anon_only):
-            return False
-        matched_filter = None
-        lower_body = q.body.lower()
-        for s in user.settings.filters_str:
-            if s.lower() in lower_body:
-                matched_filter = s
-                break
+        verdicts = self.worker.verdicts
+        if verdicts is not None and q.is_shoutout:
+            # The same shoutout is usually sent to many users.
+            match = partial(self.match, user, q)
+            matched_filter = verdicts.get(q, user.text_filter.key, match)
         else:
-            for p in user.settings.filters_re:
-                if re.search(p, q.body):
-                    matched_filter = p
-                    break
+            matched_filter = self.match(user, q)
         if matched_filter:
             self.worker.logger.info(
                 f"Got {q.type}:{q.id} for {user.uname}: {q.author=} {matched_filter=}"
@@ -71,14 +124,30 @@ class TextFilterHandler(Handler):
             return True
         return False
 
+    def match(self, user, q):
+        start = time.perf_counter()
+        matched_filter = user.text_filter.match(q.body)
+        delta = time.perf_counter() - start
+        if delta * 1000 > self.worker.config.regex_budget_ms:
+            # Matching can't be interrupted, but we can avoid doing this again.
+            self.worker.logger.warning(
+                f"User {user.uname}: filters took {delta:.2f}s on {q.id}, disabling regexes"
+            )
+            user.text_filter.disable_regexes()
+            user.handler_plan = None  # it may have no filters left
+        return matched_filter
+
 
 class StaleFilterHandler(Handler):
-    def enabled_for(self, user):
-        return user.settings.delete_after != 0 and self.worker.current_job == "long"
+    indexable = True
+
+    def min_age(self, user):
+        return user.settings.delete_after * SEC_IN_DAY
+
+    def enabled_for(self, user, job):
+        return user.settings.delete_after != 0 and job == "long"
 
     def handle_question(self, user, q):
-        if not q.is_regular or (not q.is_anon and user.settings.filter_anon_only):
-            return False
         threshold = user.settings.delete_after
         if time.time() - q.updated_at > threshold * SEC_IN_DAY:
             ts = time.asctime(time.gmtime(q.updated_at))
@@ -91,12 +160,20 @@ class StaleFilterHandler(Handler):
 
 
 class RescueHandler(Handler):
-    def enabled_for(self, user):
-        return user.settings.rescue and self.worker.current_job == "long"
+    # Index rows may be stale, e.g. a question answered since the last scan
+    # would get a spurious answer (deleting one that's gone is harmless, rescuing isn't).
+    indexable = False
+
+    def min_age(self, user):
+        return SEC_IN_YEAR
+
+    def enabled_for(self, user, job):
+        return user.settings.rescue and job == "long"
+
+    def question_types(self, user):
+        return REGULAR_TYPES
 
     def handle_question(self, user, q):
-        if not q.is_regular:
-            return False
         if time.time() - q.updated_at > SEC_IN_YEAR:
             ts = time.asctime(time.gmtime(q.updated_at))
             self.worker.logger.info(f"Got {q.type}:{q.id} for {user.uname}: {ts=}")
@@ -1,9 +1,16 @@
+from sys import intern
 from typing import Optional
 
 from askfmforhumans.util import MyDataclass
 
+REGULAR_TYPES = frozenset(("anonymous", "user", "shoutout", "anonshoutout"))
+ANON_TYPES = frozenset(("anonymous", "anonshoutout"))
+SHOUTOUT_TYPES = frozenset(("shoutout", "anonshoutout"))
+
 
 class UserProfile(MyDataclass):
+    __slots__ = ("full_name", "bio", "hashtags")
+
     full_name: str
     bio: str
     hashtags: list[str]
@@ -13,11 +20,14 @@ class UserProfile(MyDataclass):
         return cls(
             full_name=obj["fullName"],
             bio=obj["bio"].replace("\r\n", "\n"),
-            hashtags=obj["hashtags"],
+            hashtags=[intern(h) for h in obj["hashtags"]],
         )
 
 
 class Question(MyDataclass):
+    # Created for every question on every tick, so keep them small.
+    __slots__ = ("id", "type", "author", "body", "created_at", "updated_at")
+
     id: int
     type: str
     author: Optional[str]
@@ -28,25 +38,26 @@ class Question(MyDataclass):
     @property
     def is_regular(self):
         # excludes "thread" and "daily"
-        return self.type in ("anonymous", "user", "shoutout", "anonshoutout")
+        return self.type in REGULAR_TYPES
 
     @property
     def is_anon(self):
         # I suspect questions from a disabled account will be anon in this sense,
         # but won't have an author (didn't check). Be aware.
-        return self.type in ("anonymous", "anonshoutout")
+        return self.type in ANON_TYPES
 
     @property
     def is_shoutout(self):
-        return self.type in ("shoutout", "anonshoutout")
+        return self.type in SHOUTOUT_TYPES
 
     @classmethod
     def from_api_obj(cls, obj):
+        author = obj["author"]
         return cls(
-            id=obj["qid"],
-            type=obj["type"],
-            author=obj["author"],
-            body=obj["body"],
-            created_at=obj["createdAt"],
-            updated_at=obj["updatedAt"],
+            obj["qid"],
+            intern(obj["type"]),
+            author and intern(author),
+            obj["body"],
+            obj["createdAt"],
+            obj["updatedAt"],
         )
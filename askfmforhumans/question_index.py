@@ -0,0 +1,94 @@
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS questions (
+    uname TEXT NOT NULL,
+    qid INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    updated_at INTEGER NOT NULL,
+    PRIMARY KEY (uname, qid)
+);
+CREATE INDEX IF NOT EXISTS questions_updated_at ON questions (uname, updated_at);
+CREATE TABLE IF NOT EXISTS scans (
+    uname TEXT PRIMARY KEY,
+    scanned_at REAL NOT NULL
+);
+"""
+
+
+class QuestionIndex:
+    """Local index of users' questions, without their bodies and authors.
+
+    It's complete for a user only after a full inbox scan (see `rebuild`),
+    and is kept up to date by `track`ing new questions and `remove`ing deleted ones.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def scanned_at(self, uname):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT scanned_at FROM scans WHERE uname = ?", (uname,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def track(self, uname, qs):
+        """Pass through API question objects `qs`, adding them to the index."""
+        # Add before yielding, as the question may get removed by the consumer.
+        for q in qs:
+            if q["type"] != "daily":
+                row = (uname, q["qid"], q["type"], q["createdAt"], q["updatedAt"])
+                with self.lock:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO questions VALUES (?, ?, ?, ?, ?)", row
+                    )
+            yield q
+        with self.lock:
+            self.db.commit()
+
+    def rebuild(self, uname, qs):
+        """Like `track`, but also drop all other questions of `uname`.
+
+        The index becomes complete for `uname` once `qs` is exhausted.
+        """
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM scans WHERE uname = ?", (uname,))
+            self.db.execute("DELETE FROM questions WHERE uname = ?", (uname,))
+        yield from self.track(uname, qs)
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO scans VALUES (?, ?)", (uname, time.time())
+            )
+
+    def older_than(self, uname, timestamp):
+        """Return question objects updated before `timestamp`, oldest first.
+
+        Objects lack `author` and `body`.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT qid, type, created_at, updated_at FROM questions"
+                " WHERE uname = ? AND updated_at < ? ORDER BY updated_at",
+                (uname, timestamp),
+            ).fetchall()
+        for qid, type_, created_at, updated_at in rows:
+            yield {
+                "qid": qid,
+                "type": type_,
+                "author": None,
+                "body": "",
+                "createdAt": created_at,
+                "updatedAt": updated_at,
+            }
+
+    def remove(self, uname, qid):
+        with self.lock, self.db:
+            self.db.execute(
+                "DELETE FROM questions WHERE uname = ? AND qid = ?", (uname, qid)
+            )
@@ -0,0 +1,218 @@
+from bisect import bisect
+import hashlib
+import os
+import socket
+import threading
+import time
+
+from askfmforhumans.app import AppModuleBase
+from askfmforhumans.util import MyDataclass
+
+LEASE_KEY = "lease"
+MODIFIED_KEY = "modified_at"  # stamped by `UserManager` on every write
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, nodes, vnodes):
+        points = sorted((_hash(f"{n}#{i}"), n) for n in nodes for i in range(vnodes))
+        self._keys = [p[0] for p in points]
+        self._nodes = [p[1] for p in points]
+
+    def get(self, key):
+        if not self._nodes:
+            return None
+        idx = bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._nodes[idx]
+
+
+class ShardManagerConfig(MyDataclass):
+    instance_id: str = None
+    heartbeat_sec: int = 15
+    lease_sec: int = 60
+    lease_margin_sec: int = 15
+    full_scan_interval_sec: int = 3600
+    vnodes: int = 64
+
+
+class ShardManager(AppModuleBase):
+    """Split users between app instances sharing the same database.
+
+    Every instance heartbeats into the `instances` collection.
+    Unames are assigned to live instances by consistent hashing,
+    and an instance only works with users it holds a lease on.
+    Leases are stored in user documents and expire unless renewed,
+    so users of a dead instance are picked up by the others.
+    They're renewed by a thread of their own, so long jobs don't block it,
+    and a lease stops counting `lease_margin_sec` before it expires.
+    """
+
+    def __init__(self, info):
+        super().__init__(info, config_factory=ShardManagerConfig.from_dict)
+        data_mgr = info.app.require_module("data_mgr")
+        self.instances = data_mgr.db_collection("instances")
+        self.users = data_mgr.db_collection("users")
+        if self.users is None:
+            raise AssertionError("Shard manager: no database")
+
+        self.id = self.config.instance_id or (
+            f"{socket.gethostname()}:{os.getpid()}:{os.urandom(3).hex()}"
+        )
+        self.logger.info(f"Instance id: {self.id}")
+        self.live = None
+        self.ring = HashRing([], 0)
+        self.unames = set()  # all users, see `refresh_unames`
+        self.mine = set()  # unames assigned to this instance by the ring
+        self._watermark = None
+        self._next_full_scan = 0
+        self.leased = {}  # uname -> lease expiry
+        self.lock = threading.Lock()
+        self._stopped = threading.Event()
+
+        self.heartbeat()
+        self.thread = threading.Thread(
+            target=self.run_heartbeat, name="shard_heartbeat", daemon=True
+        )
+        self.thread.start()
+
+    def owns(self, uname):
+        until = self.leased.get(uname)
+        return until is not None and time.time() < until - self.config.lease_margin_sec
+
+    def claim(self, uname):
+        """Return whether `uname` belongs to this instance, leasing it if needed."""
+        if self.owns(uname):
+            return True
+        with self.lock:
+            if self.ring.get(uname) != self.id:
+                return False
+            now = time.time()
+            if self._acquire(uname, now):
+                self.leased[uname] = now + self.config.lease_sec
+                self.unames.add(uname)
+                self.mine.add(uname)
+                return True
+        return False
+
+    def run_heartbeat(self):
+        while not self._stopped.wait(self.config.heartbeat_sec):
+            try:
+                self.heartbeat()
+            except Exception:  # leases must keep being renewed
+                self.logger.exception("heartbeat:")
+
+    def stop(self):
+        """Stop renewing leases, they'll expire and be taken over."""
+        self._stopped.set()
+
+    def heartbeat(self):
+        with self.lock:
+            self._heartbeat()
+
+    def _heartbeat(self):
+        now = time.time()
+        expired = now - self.config.lease_sec
+        self.instances.update_one(
+            {"_id": self.id}, {"$set": {"heartbeat_at": now}}, upsert=True
+        )
+        self.instances.delete_many({"heartbeat_at": {"$lt": expired - 3600}})
+        live = sorted(
+            d["_id"] for d in self.instances.find({"heartbeat_at": {"$gt": expired}})
+        )
+        if live != self.live:
+            self.live = live
+            self.ring = HashRing(live, self.config.vnodes)
+            self.mine = {u for u in self.unames if self.ring.get(u) == self.id}
+        self.refresh_unames()
+
+        leased = set(self.leased)
+        released = list(leased - self.mine)
+        held = {f"{LEASE_KEY}.owner": self.id}
+        if released:
+            # Stop owning them before anybody else can.
+            for uname in released:
+                self.leased.pop(uname, None)
+            self.users.update_many(
+                {"uname": {"$in": released}, **held}, {"$unset": {LEASE_KEY: ""}}
+            )
+            leased.difference_update(released)
+
+        until = now + self.config.lease_sec
+        if leased:
+            # Our expired leases are renewed too, unless they were taken over.
+            res = self.users.update_many(
+                {"uname": {"$in": list(leased)}, **held},
+                {"$set": {f"{LEASE_KEY}.until": until}},
+            )
+            if res.matched_count < len(leased):
+                query = {"uname": {"$in": list(leased)}, **held}
+                leased = {d["uname"] for d in self.users.find(query, {"uname": True})}
+
+        gained = {u for u in self.mine - leased if self._acquire(u, now, insert=False)}
+        leased |= gained
+        self.leased = dict.fromkeys(leased, until)
+        if gained or released:
+            self.logger.info(
+                f"Rebalanced: {len(live)=} {len(leased)=} {len(gained)=} {len(released)=}"
+            )
+            self.logger.debug(f"Rebalanced: {gained=} {released=}")
+
+    def refresh_unames(self):
+        """Update the set of all unames, reading only documents modified since last time.
+
+        Documents lacking `MODIFIED_KEY` (e.g. inserted by `claim`, which `UserManager`
+        stamps soon after) are found by a full scan every `full_scan_interval_sec`.
+        """
+        now = time.monotonic()
+        full = now >= self._next_full_scan
+        watermark = None if full else self._watermark
+        if full:
+            query = {}
+        elif watermark is not None:
+            query = {MODIFIED_KEY: {"$gte": watermark}}
+        else:
+            query = {MODIFIED_KEY: {"$ne": None}}
+        projection = {"_id": False, "uname": True, MODIFIED_KEY: True}
+        unames = set()
+        for doc in self.users.find(query, projection):
+            unames.add(doc["uname"])
+            modified_at = doc.get(MODIFIED_KEY)
+            if modified_at is not None and (
+                watermark is None or modified_at > watermark
+            ):
+                watermark = modified_at
+
+        if full:
+            self._next_full_scan = now + self.config.full_scan_interval_sec
+            self.unames = unames
+            self.mine = {u for u in unames if self.ring.get(u) == self.id}
+        else:
+            for uname in unames - self.unames:
+                self.unames.add(uname)
+                if self.ring.get(uname) == self.id:
+                    self.mine.add(uname)
+        self._watermark = watermark
+
+    def _acquire(self, uname, now, *, insert=True):
+        lease = {"owner": self.id, "until": now + self.config.lease_sec}
+        free = {
+            "$or": [
+                {LEASE_KEY: None},
+                {f"{LEASE_KEY}.owner": self.id},
+                {f"{LEASE_KEY}.until": {"$lt": now}},
+            ]
+        }
+        res = self.users.update_one(
+            {"uname": uname, **free}, {"$set": {LEASE_KEY: lease}}
+        )
+        if res.matched_count:
+            return True
+        if not insert:
+            return False
+        if self.users.find_one({"uname": uname}, {"_id": True}) is None:
+            self.users.insert_one({"uname": uname, LEASE_KEY: lease})
+            return True
+        return False
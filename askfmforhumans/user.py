@@ -1,10 +1,13 @@
 from dataclasses import field
 from enum import Enum
 
+from askfmforhumans.filters import TextFilter, check_regex
 from askfmforhumans.models import UserProfile
 from askfmforhumans.ui_strings import user_settings_map
 from askfmforhumans.util import MyDataclass
 
+_UNSET = object()
+
 
 class UserModel(MyDataclass):
     created_by: str = None
@@ -13,6 +16,13 @@ class UserModel(MyDataclass):
     device_id: str = None
     access_token: str = None
     password: str = None
+    questions_cursor: list = None  # see `ExtendedApi.fetch_new_questions`
+
+    def __setattr__(self, name, value):
+        # Track fields changed since the last sync in `self.dirty`.
+        if self.__dict__.get(name, _UNSET) != value:
+            self.__dict__.setdefault("dirty", set()).add(name)
+        super().__setattr__(name, value)
 
 
 class FilterSchedule(Enum):
@@ -34,7 +44,12 @@ class UserSettings(MyDataclass):
     filter_schedule: FilterSchedule = FilterSchedule.DAILY
 
     @staticmethod
-    def from_raw(raw, /):
+    def from_raw(raw, /, *, rejected=None):
+        """Parse settings from `(key, value)` pairs.
+
+        Unsafe regex filters are skipped and, if `rejected` is a list,
+        appended to it as `(pattern, reason)` pairs.
+        """
         schema = UserSettings.__annotations__
         res = UserSettings()
         for k, v in raw:
@@ -50,7 +65,10 @@ class UserSettings(MyDataclass):
                 if v.isascii() and v.isdigit():
                     setattr(res, k, int(v))
             elif vtype == list[str]:
-                if v:
+                if k == "filters_re" and (reason := check_regex(v)):
+                    if rejected is not None:
+                        rejected.append((v, reason))
+                elif v:
                     getattr(res, k).append(v)
             elif isinstance(vtype, type) and issubclass(vtype, Enum):
                 v = v.lower()
@@ -65,10 +83,15 @@ class User:
         self.uname = uname
         self.mgr = mgr
         self.model = UserModel()
+        self.model.dirty.clear()
         self.settings = UserSettings()
+        self.text_filter = TextFilter([], [])
+        self.handler_plan = None  # see `UserWorker.plan_for`
         self.profile = None
         self.raw_settings = None
-        self.api = mgr.api_manager.create_api(auto_refresh_session=False)
+        self.profile_interval = 0
+        self.profile_due = 0
+        self.api = mgr.api_manager.create_api(account=uname, auto_refresh_session=False)
 
     @property
     def active(self):
@@ -89,6 +112,8 @@ class User:
 
     def pre_sync(self):
         self.model.access_token = self.api.access_token
+        if cursor := self.api.questions_cursor:
+            self.model.questions_cursor = list(cursor)
 
     def try_auth(self):
         api = self.api
@@ -106,23 +131,45 @@ class User:
         return True
 
     def set_model(self, model):
-        model = self.model = UserModel.from_dict(model)
+        self.model = UserModel.from_dict(model)
+        self.apply_model()
+
+    def update_model(self, upd):
+        """Apply remote changes `upd` to the model without marking them dirty."""
+        for k, v in upd.items():
+            setattr(self.model, k, v)
+        self.model.dirty.difference_update(upd)
+        self.apply_model()
+
+    def apply_model(self):
+        model = self.model
         api = self.api
         api.device_id = model.device_id or api.device_id
         api.auth = (self.uname, model.password) if model.password else None
         api.access_token = model.access_token or api.access_token
+        if model.questions_cursor:
+            api.questions_cursor = tuple(model.questions_cursor)
 
     def set_profile(self, profile):
+        """Set the profile from an API object and return whether it has changed."""
         old_allowed = self.allowed
+        old_profile = self.profile
         self.profile = UserProfile.from_api_obj(profile)
         raw_settings = self.extract_settings(self.profile.bio)
         if self.raw_settings != raw_settings:
             self.raw_settings = raw_settings
-            self.settings = settings = UserSettings.from_raw(raw_settings)
+            rejected = []
+            settings = UserSettings.from_raw(raw_settings, rejected=rejected)
+            self.settings = settings
             self.mgr.logger.info(f"User {self.uname}: {settings=} {raw_settings=}")
+            if rejected:
+                self.mgr.logger.warning(f"User {self.uname}: {rejected=}")
+            self.text_filter = TextFilter(settings.filters_str, settings.filters_re)
+            self.handler_plan = None
         allowed = self.allowed
         if allowed != old_allowed:
             self.mgr.logger.info(f"User {self.uname}: {allowed=}")
+        return self.profile != old_profile
 
     def extract_settings(self, bio):
         header = self.mgr.config.settings_header
@@ -1,12 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import field
+import threading
+import time
 
 from askfmforhumans.api import ExtendedApi
 from askfmforhumans.api import requests as r
 from askfmforhumans.app import AppModuleBase, IntervalJob
-from askfmforhumans.user import User
+from askfmforhumans.sharding import LEASE_KEY, MODIFIED_KEY
+from askfmforhumans.user import User, UserModel
 from askfmforhumans.util import MyDataclass
 
 DEFAULT_CREATED_BY = "app"
+PROJECTION = {"_id": False, LEASE_KEY: False}
 
 
 class UserManagerConfig(MyDataclass):
@@ -16,6 +21,13 @@ class UserManagerConfig(MyDataclass):
     sync_users: bool = True
     users: dict = field(default_factory=dict)
     tick_interval_sec: int = 30
+    sharded: bool = False
+    sync_batch_size: int = 500
+    full_sync_interval_sec: int = 3600
+    sync_change_stream: bool = False
+    profile_min_interval_sec: int = 30
+    profile_max_interval_sec: int = 600
+    max_concurrency: int = 8
 
 
 class UserManager(AppModuleBase):
@@ -30,23 +42,70 @@ class UserManager(AppModuleBase):
         if self.config.require_hashtag and not self.config.hashtag:
             raise AssertionError("User manager: no hashtag provided")
 
+        self.shard = None
+        if self.config.sharded:
+            if not self.config.sync_users:
+                raise AssertionError("User manager: sharding requires sync_users")
+            self.shard = info.app.require_module("shard_mgr")
+
         self.api_manager = info.app.require_module("api_mgr")
         self.users = {}
-        self._old_models = {}
+        self._watermark = None
+        self._next_full_sync = 0
+        self._change_stream = None
+        self._synced_shard = set()
+        # Jobs may run concurrently (see `App.run_async`), guard user creation.
+        self.lock = threading.RLock()
+        # Profiles and sessions are refreshed concurrently.
+        self.executor = ThreadPoolExecutor(
+            max(1, self.config.max_concurrency), thread_name_prefix="user_mgr"
+        )
 
-        for uname, model in self.config.users.items():
-            self.get_or_create_user(uname, model)
+        with self.lock:
+            self.preload_users()
 
         self.add_job(IntervalJob("tick", self.tick, self.config.tick_interval_sec))
 
     @property
     def active_users(self):
-        return [u for u in self.users.values() if u.active]
+        return [u for u in list(self.users.values()) if u.active and self.owns(u.uname)]
+
+    def owns(self, uname):
+        return self.shard is None or self.shard.owns(uname)
+
+    def claim(self, uname):
+        return self.shard is None or self.shard.claim(uname)
+
+    def get_or_create_user(self, uname, model, *, profile=None):
+        """Return the user `uname`, creating it with `model` if needed.
 
-    def get_or_create_user(self, uname, model):
+        A `profile` API object (e.g. from search results) saves fetching it.
+        """
+        with self.lock:
+            return self._get_or_create_user(uname, model, profile)
+
+    def _get_or_create_user(self, uname, model, profile):
         if uname in self.users:
             return self.users[uname]
 
+        remote_model = None
+        if self.config.sync_users:
+            remote_model = self.db.find_one({"uname": uname}, PROJECTION) or {}
+        user, op = self.create_user(uname, model, remote_model)
+        self.write_models([op])
+
+        if profile is not None:
+            user.set_profile(profile)
+            user.profile_interval = self.config.profile_min_interval_sec
+            user.profile_due = time.monotonic() + user.profile_interval
+        self.update_user(user, force=profile is None)
+        return user
+
+    def create_user(self, uname, model, remote_model):
+        """Create a user from the initial `model` and return it with the pending db write.
+
+        `remote_model` is the user's document ({} if missing), or None without `sync_users`.
+        """
         user = self.users[uname] = User(uname, self)
         model = {
             "created_by": DEFAULT_CREATED_BY,
@@ -56,53 +115,250 @@ class UserManager(AppModuleBase):
         user.set_model(model)
         self.logger.info(f"Created user {uname}: {model=}")
 
-        if self.config.sync_users:
-            remote_model = self.db.find_one({"uname": uname}) or {}
-            self.sync_user(user, remote_model)
+        op = None
+        if remote_model is not None:
+            remote_model.pop(MODIFIED_KEY, None)
+            # Existing remote values take precedence over the initial model.
+            user.model.dirty.difference_update(remote_model)
+            op = self.sync_user(user, remote_model)
+        return user, op
 
-        self.update_user(user)
-        return user
+    def preload_users(self):
+        """Create configured users and load all the others from the db in one query.
+
+        Then fetch their profiles and log them in concurrently.
+        """
+        start = time.monotonic()
+        remote_models, unstamped = {}, set()
+        if self.config.sync_users:
+            remote_models, unstamped = self.fetch_remote_models()
+        ops = []
+        for uname, model in self.config.users.items():
+            if self.claim(uname):
+                remote_model = None
+                if self.config.sync_users:
+                    remote_model = remote_models.pop(uname, {})
+                ops.append(self.create_user(uname, model, remote_model)[1])
+        if self.config.sync_users:
+            ops += self.sync_remote_models(remote_models, unstamped)
+        self.write_models(ops)
+        self.update_users(list(self.users.values()), force=True)
+        delta = time.monotonic() - start
+        self.logger.info(f"Preloaded {len(self.users)} users in {delta:.2f}s")
 
     def tick(self):
         if self.config.sync_users:
-            self.sync_users()
-        for user in self.users.values():
-            self.update_user(user)
+            with self.lock:
+                self.sync_users()
+        self.update_users([u for u in list(self.users.values()) if self.owns(u.uname)])
 
     def sync_users(self):
-        remote_models = {u["uname"]: u for u in self.db.find()}
-        all_unames = set(remote_models) | set(self.users)
+        self.write_models(self.sync_remote_models(*self.fetch_remote_models()))
+
+    def sync_remote_models(self, remote_models, unstamped):
+        """Sync all owned users with `remote_models` and return the pending db writes."""
+        from pymongo import UpdateOne  # deferred, see `DataManager`
+
+        all_unames = set(remote_models) | {u for u in self.users if self.owns(u)}
+        ops = []
         for uname in all_unames:
             if uname not in self.users:
                 self.users[uname] = User(uname, self)
             user = self.users[uname]
-            self.sync_user(user, remote_models.get(uname, {}))
+            op = self.sync_user(user, remote_models.get(uname))
+            if op is None and uname in unstamped:
+                op = UpdateOne({"uname": uname}, {"$currentDate": {MODIFIED_KEY: True}})
+            ops.append(op)
+        return ops
+
+    def fetch_remote_models(self):
+        """Return changed remote models and unames of models lacking a timestamp.
+
+        Every write stamps the document with `MODIFIED_KEY` (server time),
+        so normally only documents modified since the last seen stamp are fetched.
+        With `sync_change_stream`, changed documents are found via a change stream instead,
+        which also catches edits made outside this app.
+        Documents are fully rescanned every `full_sync_interval_sec`.
+        """
+        query = {} if self.shard is None else {f"{LEASE_KEY}.owner": self.shard.id}
+        now = time.monotonic()
+        if now >= self._next_full_sync:
+            self._next_full_sync = now + self.config.full_sync_interval_sec
+            self._watermark = None
+            if self.config.sync_change_stream:
+                self.open_change_stream()
+        else:
+            conds = []
+            if self._change_stream is not None:
+                if changed := self.read_change_stream():
+                    conds.append({"uname": {"$in": changed}})
+            elif (wm := self._watermark) is not None:
+                conds += [{MODIFIED_KEY: {"$gte": wm}}, {MODIFIED_KEY: None}]
+            else:
+                # No stamped documents seen yet (e.g. only legacy ones), fetch all.
+                conds.append({})
+            if self.shard is not None:
+                # Users leased since the last sync may have stale local state.
+                if regained := list(self.shard.leased.keys() - self._synced_shard):
+                    conds.append({"uname": {"$in": regained}})
+            if not conds:
+                return {}, set()
+            query["$or"] = conds
+        if self.shard is not None:
+            self._synced_shard = set(self.shard.leased)
+
+        models, unstamped = {}, set()
+        for doc in self.db.find(query, PROJECTION):
+            uname = doc["uname"]
+            models[uname] = doc
+            modified_at = doc.pop(MODIFIED_KEY, None)
+            if modified_at is None:
+                unstamped.add(uname)
+            elif self._watermark is None or modified_at > self._watermark:
+                self._watermark = modified_at
+        self.logger.debug(f"fetch_remote_models(): {len(models)=} {query=}")
+        return models, unstamped
+
+    def open_change_stream(self):
+        from pymongo.errors import PyMongoError
+
+        if self._change_stream is not None:
+            self._change_stream.close()
+            self._change_stream = None
+        # Skip updates touching only the lease (see `ShardManager.heartbeat`).
+        prefix = {"$substrCP": ["$$this.k", 0, len(LEASE_KEY)]}
+        updated = {
+            "$filter": {
+                "input": {"$objectToArray": "$updateDescription.updatedFields"},
+                "cond": {"$ne": [prefix, LEASE_KEY]},
+            }
+        }
+        removed = {"$setDifference": ["$updateDescription.removedFields", [LEASE_KEY]]}
+        relevant = {
+            "$or": [
+                {"$ne": ["$operationType", "update"]},
+                {"$gt": [{"$size": updated}, 0]},
+                {"$gt": [{"$size": removed}, 0]},
+            ]
+        }
+        pipeline = [
+            {"$match": {"$expr": relevant}},
+            {"$project": {"fullDocument.uname": True}},
+        ]
+        try:
+            self._change_stream = self.db.watch(pipeline, full_document="updateLookup")
+        except PyMongoError:
+            self.logger.exception("Change stream unavailable, using timestamps:")
+
+    def read_change_stream(self):
+        from pymongo.errors import PyMongoError
+
+        unames = set()
+        try:
+            while (change := self._change_stream.try_next()) is not None:
+                if doc := change.get("fullDocument"):
+                    unames.add(doc["uname"])
+        except PyMongoError:
+            self.logger.exception("Change stream failed, rescanning:")
+            self._next_full_sync = 0
+        return list(unames)
 
     def sync_user(self, user, remote_model):
+        """Sync `user` with `remote_model` and return the pending db write, if any.
+
+        `remote_model` is None if it hasn't changed since the last sync.
+        Remote changes are applied to fields that weren't modified locally.
+        """
+        from pymongo import UpdateOne
+
         uname = user.uname
-        old_model = self._old_models.get(uname, {})
+        model = user.model
         user.pre_sync()
+        if remote_model is None and not model.dirty:
+            return None
+        dirty = set(model.dirty)
 
         # remote -> local sync
-        upd_remote = {k: v for k, v in remote_model.items() if old_model.get(k) != v}
-        new_model = remote_model | user.model.as_dict() | upd_remote
-        self._old_models[uname] = new_model
-        user.set_model(new_model)
+        upd_remote = {}
+        if remote_model is not None:
+            upd_remote = {
+                k: v
+                for k, v in remote_model.items()
+                if k in UserModel.__dataclass_fields__
+                and k not in dirty
+                and getattr(model, k) != v
+            }
+            user.update_model(upd_remote)
+            if upd_remote:
+                self.force_refresh(uname)
 
         # local -> remote sync
-        upd_local = {k: v for k, v in new_model.items() if remote_model.get(k) != v}
+        op = None
+        remote_model = remote_model or {}
+        upd_local = {
+            k: getattr(model, k)
+            for k in dirty
+            if k not in remote_model or remote_model[k] != getattr(model, k)
+        }
+        model.dirty.difference_update(dirty)
         if upd_local:
             query = {"uname": uname}
-            update = {"$set": upd_local, "$setOnInsert": query}
-            self.db.update_one(query, update, upsert=True)
+            update = {
+                "$set": upd_local,
+                "$setOnInsert": query,
+                "$currentDate": {MODIFIED_KEY: True},
+            }
+            op = UpdateOne(query, update, upsert=True)
 
         if upd_remote or upd_local:
             self.logger.info(f"User sync: {uname=} {upd_remote=} {upd_local=}")
+        return op
+
+    def write_models(self, ops):
+        ops = [op for op in ops if op is not None]
+        if not ops:
+            return
+        start = time.monotonic()
+        modified = upserted = 0
+        size = max(1, self.config.sync_batch_size)
+        for i in range(0, len(ops), size):
+            res = self.db.bulk_write(ops[i : i + size], ordered=False)
+            modified += res.modified_count
+            upserted += res.upserted_count
+        delta = time.monotonic() - start
+        self.logger.info(
+            f"User sync: wrote {len(ops)} models in {delta:.2f}s: {modified=} {upserted=}"
+        )
+
+    def update_users(self, users, *, force=False):
+        futures = [
+            self.executor.submit(self.update_user, u, force=force) for u in users
+        ]
+        for fut in futures:
+            fut.result()
+
+    def update_user(self, user, *, force=False):
+        """Refresh the profile when it's due and log the user in if allowed.
+
+        Profiles are polled every `profile_min_interval_sec` after a change,
+        and the interval doubles while they stay the same, up to `profile_max_interval_sec`.
+        """
+        if user.model.ignored:
+            return
+        now = time.monotonic()
+        if force or now >= user.profile_due:
+            cfg = self.config
+            profile = self.api_manager.anon_api.request(r.fetch_profile(user.uname))
+            if user.set_profile(profile):
+                interval = cfg.profile_min_interval_sec
+            else:
+                interval = min(user.profile_interval * 2, cfg.profile_max_interval_sec)
+            user.profile_interval = max(interval, cfg.profile_min_interval_sec)
+            user.profile_due = now + user.profile_interval
+        if user.allowed:
+            user.try_auth()
 
-    def update_user(self, user):
-        if not user.model.ignored:
-            user.set_profile(
-                self.api_manager.anon_api.request(r.fetch_profile(user.uname))
-            )
-            if user.allowed:
-                user.try_auth()
+    def force_refresh(self, uname):
+        """Make the next tick fetch the profile of `uname`."""
+        if user := self.users.get(uname):
+            user.profile_due = 0
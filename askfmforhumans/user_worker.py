@@ -1,7 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+import hashlib
+import time
+
 from askfmforhumans import handlers, ui_strings
+from askfmforhumans.actions import ActionPipeline
+from askfmforhumans.api import AskfmApiError, OperationError
 from askfmforhumans.api import requests as r
-from askfmforhumans.app import AppModuleBase, DailyJob, IntervalJob
+from askfmforhumans.app import AppModuleBase, DailyJob, IntervalJob, SliceJob
+from askfmforhumans.errors import AppError
+from askfmforhumans.filters import VerdictCache
+from askfmforhumans.handlers import SEC_IN_DAY
 from askfmforhumans.models import Question
+from askfmforhumans.question_index import QuestionIndex
 from askfmforhumans.util import MyDataclass
 
 # Note: ASKfm threads are complex, so this module ignores them for now
@@ -10,60 +21,324 @@ from askfmforhumans.util import MyDataclass
 class UserWorkerConfig(MyDataclass):
     job_interval_sec: int = 30
     daily_job_time_utc: str = "00:00"
+    max_concurrency: int = 8
+    regex_budget_ms: int = 100
+    question_index: bool = False
+    question_index_path: str = "questions.sqlite3"
+    question_index_max_age_days: int = 7
+    daily_spread_sec: int = 0
+    per_user_jobs: bool = False
+    user_budget_ms: int = 500
+    action_pipeline: bool = False
+    action_concurrency: int = 4
+    verdict_cache_size: int = 10000
+    verdict_cache_ttl_sec: int = 3600
+    stats_interval_sec: int = 600
+    shoutout_interval_sec: int = 0
+    shoutout_concurrency: int = 4
 
 
 class UserWorker(AppModuleBase):
     def __init__(self, info):
         super().__init__(info, config_factory=UserWorkerConfig.from_dict)
         self.umgr = info.app.require_module("user_mgr")
+        self.shoutout_handler = handlers.ShoutoutHandler(self)
         self.handlers = [
-            handlers.ShoutoutHandler(self),
+            self.shoutout_handler,
             handlers.TextFilterHandler(self),
             handlers.StaleFilterHandler(self),
             handlers.RescueHandler(self),
         ]
-        self.add_job(IntervalJob("short", self.short_job, self.config.job_interval_sec))
-        self.add_job(DailyJob("long", self.long_job, self.config.daily_job_time_utc))
-        self.current_job = None
+        # Each user is processed by a single task, so per-user order is preserved.
+        self.executor = ThreadPoolExecutor(
+            max(1, self.config.max_concurrency), thread_name_prefix="user_worker"
+        )
+        self.index = None
+        if self.config.question_index:
+            self.index = QuestionIndex(self.config.question_index_path)
+        self.actions = None
+        if self.config.action_pipeline:
+            # Deletes and rescues run here, so handlers don't wait for them.
+            executor = ThreadPoolExecutor(
+                max(1, self.config.action_concurrency), thread_name_prefix="actions"
+            )
+            self.actions = ActionPipeline(executor, self.logger)
+        self.verdicts = None
+        if size := self.config.verdict_cache_size:
+            self.verdicts = VerdictCache(size, self.config.verdict_cache_ttl_sec)
+        self.add_job(
+            IntervalJob(
+                "stats",
+                self.log_stats,
+                self.config.stats_interval_sec,
+                priority=1,
+                sheddable=True,
+            )
+        )
+        self.user_jobs = {}
+        if self.config.per_user_jobs:
+            # Every user gets its own short job, running on the worker pool
+            # alongside the others, see `sync_user_jobs`.
+            if not info.app.config.get("asyncio"):
+                raise AssertionError("User worker: per_user_jobs requires _app.asyncio")
+            self.add_job(
+                IntervalJob("users", self.sync_user_jobs, self.config.job_interval_sec)
+            )
+        else:
+            self.add_job(
+                IntervalJob("short", self.short_job, self.config.job_interval_sec)
+            )
+        if interval := self.config.shoutout_interval_sec:
+            # Shoutouts are public, so they get a faster lane of their own.
+            # It only helps if it can run while the other jobs do.
+            if not info.app.config.get("asyncio"):
+                raise AssertionError("User worker: shoutout lane requires _app.asyncio")
+            self.shoutout_executor = ThreadPoolExecutor(
+                max(1, self.config.shoutout_concurrency), thread_name_prefix="shoutouts"
+            )
+            self.add_job(
+                IntervalJob("shoutouts", self.shoutout_job, interval, priority=-1)
+            )
+        daily_job = DailyJob("long", self.long_job, self.config.daily_job_time_utc)
+        if spread := self.config.daily_spread_sec:
+            # Run the long job for each user at its own time in the window
+            # starting at `daily_job_time_utc`, checking for due users every short interval.
+            self.long_phase = daily_job.first_time() % SEC_IN_DAY
+            self.long_checked_at = time.time() - self.config.job_interval_sec
+            self.logger.info(f"Spreading the long job over {spread}s")
+            self.add_job(
+                IntervalJob("long", self.long_spread_job, self.config.job_interval_sec)
+            )
+        else:
+            self.add_job(daily_job)
 
     def short_job(self):
-        self.current_job = "short"
-        for user in self.umgr.active_users:
-            self.run_handlers(user)
-            if user.settings.read_shoutouts:
-                user.api.request(r.mark_notifs_as_read("SHOUTOUT"))
+        self.for_each_user(self.short_job_for)
 
-    def long_job(self):
-        self.current_job = "long"
-        for user in self.umgr.active_users:
-            self.run_handlers(user)
+    def short_job_for(self, user):
+        for _ in self.short_task(user):
+            pass
+
+    def short_task(self, user):
+        wants_qs = self.wants_new_questions(user)
+        # With the shoutout lane, it marks shoutouts as read instead.
+        reads = user.settings.read_shoutouts and not self.config.shoutout_interval_sec
+        if not (wants_qs or reads):
+            return
+        cursor = user.api.questions_cursor
+        if cursor is not None or not wants_qs:
+            # Spare idle users the fetch, the handlers and marking shoutouts as read.
+            newest = user.api.newest_question_key()
+            if newest is None or cursor is not None and newest <= cursor:
+                user.api.mgr.count("idle_probes")
+                return
+            if not wants_qs:
+                user.api.questions_cursor = newest
+        if wants_qs:
+            yield from self.iter_handlers(user, "short")
+        if reads:
+            user.api.request(r.mark_notifs_as_read("SHOUTOUT"))
+
+    def sync_user_jobs(self):
+        """Add a short job for each new active user and remove those of the others.
+
+        Their slices run concurrently on the worker pool, so a user waits for others
+        only while all of its threads are busy. A slice ends after the first question
+        handled past `user_budget_ms`, a single question (with its API calls) can
+        still take longer than that.
+        """
+        users = {u.uname: u for u in self.umgr.active_users}
+        for uname in self.user_jobs.keys() - users.keys():
+            self.remove_job(self.user_jobs.pop(uname))
+        for uname in users.keys() - self.user_jobs.keys():
+            job = SliceJob(
+                f"short.{uname}",
+                partial(self.short_task, users[uname]),
+                self.config.job_interval_sec,
+                self.config.user_budget_ms / 1000,
+                executor=self.executor,
+            )
+            self.add_job(job)
+            self.user_jobs[uname] = job
 
-    def run_handlers(self, user):
-        handlers = [h for h in self.handlers if h.enabled_for(user)]
-        if not handlers:
+    def shoutout_job(self):
+        self.for_each_user(self.shoutout_job_for, executor=self.shoutout_executor)
+
+    def shoutout_job_for(self, user):
+        """Delete new shoutouts of `user` and mark them as read.
+
+        Like `short_task`, but with a cursor of its own, and the short job
+        leaves new shoutouts to this one (see `ShoutoutHandler.enabled_for`).
+        """
+        handler = self.shoutout_handler
+        enabled = handler in self.plan_for(user).enabled["shoutouts"]
+        if not (enabled or user.settings.read_shoutouts):
             return
+        api = user.api
+        cursor = api.shoutouts_cursor
+        if cursor is not None or not enabled:
+            newest = api.newest_question_key()
+            if newest is None or cursor is not None and newest <= cursor:
+                return
+            if not enabled:
+                api.shoutouts_cursor = newest
+        if enabled:
+            for q in api.fetch_new_questions(cursor_attr="shoutouts_cursor"):
+                if q["type"] in handler.question_types(user):
+                    handler.handle_question(user, Question.from_api_obj(q))
+        if user.settings.read_shoutouts:
+            api.request(r.mark_notifs_as_read("SHOUTOUT"))
+
+    def long_job(self):
+        self.for_each_user(self.run_handlers, "long")
+
+    def long_spread_job(self):
+        now = time.time()
+        elapsed = now - self.long_checked_at
+        self.long_checked_at = now
+        users = [
+            u
+            for u in self.umgr.active_users
+            if (now - self.long_slot(u.uname)) % SEC_IN_DAY < elapsed
+        ]
+        if users:
+            self.logger.debug(f"long_spread_job(): {len(users)=}")
+            self.for_each_user(self.run_handlers, "long", users=users)
+
+    def long_slot(self, uname):
+        """Return the stable time of day (in seconds) of the long job for `uname`."""
+        digest = hashlib.md5(uname.encode()).digest()
+        offset = int.from_bytes(digest[:8], "big") % self.config.daily_spread_sec
+        return (self.long_phase + offset) % SEC_IN_DAY
+
+    def for_each_user(self, func, *args, users=None, executor=None):
+        if users is None:
+            users = self.umgr.active_users
+        executor = executor or self.executor
+        futures = {executor.submit(func, u, *args): u for u in users}
+        wait(futures)
+        for fut, user in futures.items():
+            try:
+                fut.result()
+            except (AppError, AskfmApiError):
+                self.logger.exception(f"User {user.uname}:")
 
-        if self.current_job == "short":
+    def run_handlers(self, user, job):
+        for _ in self.iter_handlers(user, job):
+            pass
+
+    def iter_handlers(self, user, job):
+        """Run handlers of `job` for `user`, yielding after every question."""
+        plan = self.plan_for(user)
+        handlers = plan.enabled[job]
+        index = self.index
+        from_index = False
+
+        if job == "short":
+            if not self.wants_new_questions(user, handlers):
+                return
             qs = user.api.fetch_new_questions()
+            if index:
+                qs = index.track(user.uname, qs)
         else:
-            qs = user.api.request_iter(r.fetch_questions())
-            qs = reversed(list(qs))  # rescue questions in the right order
+            if not handlers:
+                return
+            if index and self.can_use_index(user, handlers):
+                cutoff = time.time() - min(h.min_age(user) for h in handlers)
+                qs = index.older_than(user.uname, cutoff)
+                from_index = True
+            else:
+                # rescue questions in the right order
+                qs = user.api.fetch_questions_oldest_first()
+                if index:
+                    qs = index.rebuild(user.uname, qs)
 
         for q in qs:
+            if not (chain := plan.dispatch(job, q["type"])):
+                yield
+                continue
             q = Question.from_api_obj(q)
-            for h in handlers:
-                if h.handle_question(user, q):
-                    break
+            try:
+                for h in chain:
+                    if h.handle_question(user, q):
+                        break
+            except OperationError as e:
+                if not from_index:
+                    raise
+                # Most likely it was deleted or updated unbeknownst to the index.
+                self.logger.info(f"Dropping {q.id} from the index: {e!r}")
+                index.remove(user.uname, q.id)
+            yield
+
+    def plan_for(self, user):
+        if user.handler_plan is None:
+            user.handler_plan = handlers.HandlerPlan(self.handlers, user)
+            self.logger.debug(f"User {user.uname}: {user.handler_plan.describe()}")
+        return user.handler_plan
+
+    def wants_new_questions(self, user, handlers=None):
+        if handlers is None:
+            handlers = self.plan_for(user).enabled["short"]
+        # The index must see all new questions to be usable by the long job.
+        return bool(handlers) or bool(self.index and self.uses_index(user))
+
+    def uses_index(self, user):
+        return any(h.indexable for h in self.plan_for(user).enabled["long"])
+
+    def can_use_index(self, user, handlers):
+        if not all(h.indexable for h in handlers):
+            return False
+        scanned_at = self.index.scanned_at(user.uname)
+        max_age = self.config.question_index_max_age_days * SEC_IN_DAY
+        return scanned_at is not None and time.time() - scanned_at < max_age
+
+    def log_stats(self):
+        if self.actions:
+            self.logger.info(f"Action stats: {self.actions.status()}")
+        if self.verdicts:
+            self.logger.info(f"Verdict cache stats: {self.verdicts.status()}")
+
+    def perform(self, user, q, func, *args):
+        """Call `func(user, q, *args)`, in the background with `action_pipeline`."""
+        if self.actions is None:
+            func(user, q, *args)
+        else:
+            action = partial(self.run_action, func, user, q, *args)
+            self.actions.submit(user.uname, q.id, action)
+
+    def run_action(self, func, user, q, *args):
+        """Call `func` for `ActionPipeline`, which treats raising as a failure.
+
+        Only `OperationError` is swallowed, as it means the question is gone already.
+        """
+        try:
+            func(user, q, *args)
+        except OperationError as e:
+            # Most likely it's gone already, e.g. deleted by the user.
+            self.logger.info(f"User {user.uname}: {func.__name__} {q.id}: {e!r}")
+            if self.index:
+                self.index.remove(user.uname, q.id)
 
     def delete_question(self, user, q, *, block=False):
+        self.perform(user, q, self.do_delete_question, block)
+
+    def rescue_question(self, user, q):
+        self.perform(user, q, self.do_rescue_question)
+
+    def do_delete_question(self, user, q, block):
         if block:
             self.logger.info(f"Deleting {q.id} and blocking {q.author}")
             user.api.request(r.report_question(q.id, should_block=True))
         else:
             self.logger.info(f"Deleting {q.id}")
             user.api.request(r.delete_question(q.type, q.id))
+        if self.index:
+            self.index.remove(user.uname, q.id)
 
-    def rescue_question(self, user, q):
+    def do_rescue_question(self, user, q):
         self.logger.info(f"Rescuing {q.id}")
         user.api.request(r.post_answer(q.type, q.id, ui_strings.rescuing_answer))
         user.api.request(r.delete_answer(q.id))
+        if self.index:
+            # It's back in the inbox with a new `updatedAt`, the short job will see it.
+            self.index.remove(user.uname, q.id)
@@ -1,13 +1,24 @@
 import dataclasses
-from functools import lru_cache
-import inspect
-from typing import Any, Optional
+import threading
+import time
+from typing import Any
 
 
 class MyDataclass:
+    __slots__ = ()  # lets subclasses declare `__slots__` for compact instances
+
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
         dataclasses.dataclass(cls)
+        # Cache the schema, `from_dict` is called on every user sync.
+        fields = dataclasses.fields(cls)
+        cls._field_names = frozenset(f.name for f in fields)
+        cls._required = tuple(
+            f.name
+            for f in fields
+            if f.default is dataclasses.MISSING
+            and f.default_factory is dataclasses.MISSING
+        )
 
     @classmethod
     def from_dict(
@@ -18,13 +29,12 @@ class MyDataclass:
         allow_extra: bool = True,
         raise_errors: bool = True,
     ):
-        schema = inspect.signature(cls).parameters
         schema_name = cls.__name__
 
         # check extra keys
         if not allow_extra:
             for key in src:
-                if key in schema:
+                if key in cls._field_names:
                     continue
                 elif raise_errors:
                     raise AssertionError(
@@ -34,34 +44,42 @@ class MyDataclass:
                     return None
 
         # check required keys
-        res = {}
-        for key, param in schema.items():
+        for key in cls._required:
             if key in src:
-                res[key] = src[key]
-            elif param.default is not inspect.Parameter.empty:
                 continue
             elif raise_errors:
                 raise AssertionError(f"Key {key!r} required in schema {schema_name!r}")
             else:
                 return None
 
-        return cls(**res)
+        names = cls._field_names
+        return cls(**{k: v for k, v in src.items() if k in names})
 
     def as_dict(self):
         return dataclasses.asdict(self)
 
 
-class LRUCache:
-    def __init__(self, max_size: Optional[int] = None):
-        self._cookie = 0
-        self.cache = lru_cache(max_size)(self._get_cookie)
+class TokenBucket:
+    """Thread-safe token bucket rate limiter. A non-positive rate means no limit."""
 
-    def _get_cookie(self, val):
-        return self._cookie
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
 
-    def check_and_store(self, val):
-        """Returns True if `val` is already in the cache.
-        Otherwise, puts it into the cache and returns False.
-        """
-        self._cookie += 1
-        return self._cache(val) < self._cookie
+    def acquire(self) -> float:
+        """Take a token, sleeping until it's available. Return the time slept."""
+        if self.rate <= 0:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._updated
+            self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+            self._updated = now
+            self._tokens -= 1  # may go negative, which reserves a future token
+            delay = max(0, -self._tokens / self.rate)
+        if delay:
+            time.sleep(delay)
+        return delay
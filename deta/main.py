@@ -24,6 +24,8 @@ def run(_):
 
     # Deta runs our micro every minute with a 10s timeout.
     # So run only the most urgent jobs, but immediately.
+    # Anything queued in memory is lost afterwards: e.g. `bot.tick` onboards
+    # only a batch of discovered users, the rest are discovered again next time.
     limit = time.time() + 60
     for job in app.scheduler.queue:
         if job.time > limit:
@@ -0,0 +1,99 @@
+"""Micro-benchmark of the question handling hot path, run from the repo root:
+
+    python -m scripts.bench_handlers
+
+Runs the short job's handlers on fake questions that no filter matches
+(so no requests are made), and times building models from API objects.
+"""
+import logging
+import time
+import timeit
+
+from askfmforhumans.app import App, AppModuleInfo
+from askfmforhumans.filters import TextFilter
+from askfmforhumans.models import Question
+from askfmforhumans.user import FilterSchedule, UserModel, UserSettings
+from askfmforhumans.user_worker import UserWorker
+
+QUESTIONS = 20000
+REPEAT = 15
+
+
+class FakeApi:
+    def __init__(self, questions):
+        self.questions = questions
+        self.questions_cursor = None
+
+    def fetch_new_questions(self):
+        return iter(self.questions)
+
+
+class FakeUser:
+    def __init__(self, uname, questions, **settings):
+        self.uname = uname
+        self.api = FakeApi(questions)
+        self.settings = UserSettings(**settings)
+        self.text_filter = TextFilter(
+            self.settings.filters_str, self.settings.filters_re
+        )
+        self.handler_plan = None
+
+
+class FakeUserManager:
+    def __init__(self, info):
+        self.active_users = []
+
+
+def make_worker():
+    app = App()
+    app.use_module(AppModuleInfo("user_mgr", FakeUserManager))
+    app.use_module(AppModuleInfo("user_worker", UserWorker))
+    app.init_config({})
+    return app.require_module("user_worker")
+
+
+def make_questions(n):
+    now = int(time.time())
+    types = ("anonymous", "user", "shoutout")
+    return [
+        {
+            "qid": i,
+            "type": types[i % 3],
+            "author": f"author{i % 50}",
+            "body": "hello there " * 5,
+            "createdAt": now,
+            "updatedAt": now,
+        }
+        for i in range(n)
+    ]
+
+
+def best_of(func, number):
+    return min(timeit.repeat(func, number=number, repeat=REPEAT)) / number * 1e6
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    worker = make_worker()
+    questions = make_questions(QUESTIONS)
+    user = FakeUser(
+        "bench",
+        questions,
+        filters_str=["zzz", "yyy"],
+        filters_re=["qq+x"],
+        filter_schedule=FilterSchedule.CONTINUOUS,
+        filter_shoutouts=False,
+    )
+    per_q = best_of(lambda: worker.run_handlers(user, "short"), 1) / QUESTIONS
+    print(f"run_handlers: {per_q:.2f} us per question")
+
+    q = questions[1]
+    per_q = best_of(lambda: Question.from_api_obj(q), QUESTIONS)
+    print(f"Question.from_api_obj: {per_q:.2f} us")
+    src = {"created_by": "bench", "device_id": "d", "extra": 1}
+    per_model = best_of(lambda: UserModel.from_dict(src), QUESTIONS)
+    print(f"UserModel.from_dict: {per_model:.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""Run several shard managers against one in-memory database and check their leases.
+
+Requires mongomock (`pip install mongomock`), run from the repo root:
+
+    python -m scripts.shard_harness
+
+Checks that no user is ever owned by two instances at once,
+while instances join, that the users of a stalled instance
+stop being owned by it before the others take them over,
+and that heartbeats only read changed user documents.
+"""
+from collections import Counter
+from datetime import datetime
+import logging
+import sys
+import threading
+import time
+
+import mongomock
+
+from askfmforhumans.app import App, AppModuleInfo
+from askfmforhumans.sharding import ShardManager
+
+USERS = 200
+SHARD_CONFIG = {"heartbeat_sec": 0.5, "lease_sec": 3, "lease_margin_sec": 1}
+
+# mongomock isn't thread-safe, and every instance heartbeats from its own thread.
+db_lock = threading.RLock()
+docs_read = Counter()  # collection name -> documents returned by `find`
+
+
+class LockedCollection:
+    def __init__(self, coll):
+        self.coll = coll
+
+    def __getattr__(self, name):
+        func = getattr(self.coll, name)
+
+        def call(*args, **kwargs):
+            with db_lock:
+                res = func(*args, **kwargs)
+                if name == "find":
+                    res = list(res)
+                    docs_read[self.coll.name] += len(res)
+                return res
+
+        return call
+
+
+class FakeDataManager:
+    def __init__(self, db):
+        self.db = db
+
+    def db_collection(self, name):
+        return LockedCollection(self.db[name])
+
+
+def start_instance(db, name):
+    app = App()
+    app.use_module(AppModuleInfo("data_mgr", lambda info: FakeDataManager(db)))
+    app.use_module(AppModuleInfo("shard_mgr", ShardManager))
+    app.init_config({"shard_mgr": {"instance_id": name, **SHARD_CONFIG}})
+    return app.require_module("shard_mgr")
+
+
+class Monitor:
+    """Sample ownership of all users in the background."""
+
+    def __init__(self, shards, unames):
+        self.shards = shards
+        self.unames = unames
+        self.errors = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def owners(self, uname):
+        return [s.id for s in list(self.shards) if s.owns(uname)]
+
+    def run(self):
+        while not self.stopped.wait(0.01):
+            for uname in self.unames:
+                if len(owners := self.owners(uname)) > 1:
+                    self.errors.append(f"{uname} owned by {owners}")
+
+
+def wait_until(cond, timeout):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    db = mongomock.MongoClient().db
+    unames = [f"user{i}" for i in range(USERS)]
+    db.users.insert_many([{"uname": u} for u in unames])
+
+    shards = [start_instance(db, "a"), start_instance(db, "b")]
+    mon = Monitor(shards, unames)
+    mon.thread.start()
+    failures = []
+
+    def covered():
+        return all(mon.owners(u) for u in unames)
+
+    if not wait_until(covered, 10):
+        failures.append("users not covered by a and b")
+
+    shards.append(start_instance(db, "c"))
+    if not wait_until(lambda: covered() and shards[2].leased, 10):
+        failures.append("users not rebalanced after c joined")
+    print("after join:", {s.id: len(s.leased) for s in shards})
+
+    docs_read.clear()
+    time.sleep(2)  # a few heartbeats of every instance
+    print(f"user documents read by heartbeats in 2s: {docs_read['users']}")
+    if docs_read["users"] >= USERS:
+        failures.append("heartbeats read unchanged user documents")
+    newbie = "newbie"
+    db.users.insert_one({"uname": newbie, "modified_at": datetime.utcnow()})
+    if not wait_until(lambda: mon.owners(newbie), 10):
+        failures.append("new user not picked up")
+    unames.append(newbie)
+
+    stalled = shards[0]
+    orphans = [u for u in unames if stalled.owns(u)]
+    stalled.stop()
+    stalled_at = time.monotonic()
+
+    def taken_over():
+        return any(s.owns(u) for s in shards[1:] for u in orphans)
+
+    if not wait_until(taken_over, 10):
+        failures.append("users of the stalled instance not taken over")
+    elif any(stalled.owns(u) for u in orphans):
+        failures.append("stalled instance still owns users after takeover")
+    delta = time.monotonic() - stalled_at
+    print(f"takeover of {len(orphans)} users after {delta:.2f}s")
+
+    if not wait_until(lambda: all(mon.owners(u) for u in orphans), 10):
+        failures.append("users of the stalled instance not covered")
+    print("after stall:", {s.id: len(s.leased) for s in shards[1:]})
+
+    mon.stopped.set()
+    mon.thread.join()
+    for s in shards:
+        s.stop()
+    failures += mon.errors[:10]
+    for msg in failures:
+        print("FAIL:", msg)
+    print("OK" if not failures else f"{len(failures)} failures")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())